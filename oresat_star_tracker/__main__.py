@@ -5,7 +5,6 @@ import os
 from olaf import app, olaf_run, olaf_setup, render_olaf_template, rest_api
 
 from . import __version__
-from .star_tracker_service import StarTrackerService
 
 
 @rest_api.app.route("/star-tracker")
@@ -19,6 +18,10 @@ def main():
     path = os.path.dirname(os.path.abspath(__file__))
 
     args, _ = olaf_setup("star_tracker_1")
+
+    # import after arg parsing so --help and bad args don't pay for loading cv2, lost, etc
+    from .star_tracker_service import StarTrackerService  # pylint: disable=import-outside-toplevel
+
     mock_args = [i.lower() for i in args.mock_hw]
     mock_camera = "camera" in mock_args or "all" in mock_args
 
@@ -1,14 +1,14 @@
 """Star tracker AR013x camera"""
 
 import glob
-import io
 import os
 import platform
 import subprocess
 from enum import Enum
 from pathlib import Path
-from threading import Timer
+from threading import Thread
 from time import monotonic, sleep
+from typing import Optional
 
 import cv2
 import numpy as np
@@ -23,6 +23,17 @@ class CameraState(Enum):
     ERROR = 5
 
 
+class CaptureMode(Enum):
+    """What a capture is converted to."""
+
+    RAW = 1
+    """Raw bayer data, as read from the sensor"""
+    GRAY = 2
+    """Demosaiced straight to grayscale in one pass"""
+    COLOR = 3
+    """Demosaiced to BGR color"""
+
+
 class CameraError(Exception):
     """An error has occured with camera"""
 
@@ -33,41 +44,76 @@ class Camera:
     # these files are provided by the prucam-dkms debian package
 
     CAPTURE_PATH = Path("/dev/prucam")
+    CONTEXT_PATH = Path("/sys/devices/platform/prucam/context_settings")
     MAX_COLS = 1280
     MAX_ROWS = 960
     PIXEL_BYTES = MAX_COLS * MAX_ROWS
+    UNLOCK_TIME = 90.0
+    """Monotonic time since boot (in seconds) the camera is locked out for."""
+
+    _mock_frames: dict = {}
+    """Read-only blank frames shared by all mock cameras, keyed by color, made on first use."""
 
     def __init__(self, mock: bool = False):
         self._mock = mock
         self._state = CameraState.LOCKOUT
-        self._image_size = (self.MAX_COLS, self.MAX_ROWS)
-        self._mock_data = np.zeros((self.MAX_COLS, self.MAX_ROWS, 3), dtype=np.uint8)
+        self._unlock_thread: Optional[Thread] = None
+        self._image_size = (self.MAX_ROWS, self.MAX_COLS)
+        self._raw: np.ndarray
+        self._bgr: np.ndarray
+        self._gray: np.ndarray
+        self._alloc_buffers()
+
+    def _alloc_buffers(self):
+        """Allocate the reused frame buffers for the current image size."""
+
+        # mock cameras never read from the device, so they have no raw buffer
+        if not self._mock:
+            self._raw = np.empty(self._image_size, dtype=np.uint8)
+        self._bgr = np.empty((*self._image_size, 3), dtype=np.uint8)
+        self._gray = np.empty(self._image_size, dtype=np.uint8)
 
-        uptimer = Timer(90.0 - monotonic(), self.unlock)
-        uptimer.start()
+    def check_lockout(self):
+        """Unlock the camera if it is locked out and the lockout time has passed.
+
+        Building and loading the kernel module can take minutes, so a real camera is unlocked on a
+        background thread and stays locked out until that is done.
+        """
+
+        if self._state != CameraState.LOCKOUT or monotonic() < self.UNLOCK_TIME:
+            return
+
+        if self._mock:
+            self.unlock()
+        elif self._unlock_thread is None:
+            self._unlock_thread = Thread(target=self.unlock, name="camera-unlock", daemon=True)
+            self._unlock_thread.start()
 
     def unlock(self):
         if self._mock:
             self._state = CameraState.RUNNING
             return
 
+        logger.info("Unlocking camera")
+        start = monotonic()
+
         # check if kernel module is loaded
-        mod_check = subprocess.run(
-            "lsmod | grep prucam", capture_output=True, shell=True, check=False, text=True
-        )
-        if mod_check.returncode not in [0, 1]:  # error
+        try:
+            with open("/proc/modules", "r") as f:
+                mod_loaded = any(line.startswith("prucam ") for line in f)
+        except OSError:
             self._state = CameraState.ERROR
-            logger.error("Camera module not found")
+            logger.error("Could not read loaded kernel modules")
             return
 
-        def load_kernel_module():
+        def load_kernel_module() -> bool:
             logger.info("Building & installing kernel module")
             # if kernel module is not loaded; compile and insert it
             temp_path = glob.glob("/usr/src/prucam*")
             if len(temp_path) != 1:
                 self._state = CameraState.ERROR
                 logger.error("Kernel module install path not found")
-                return
+                return False
             install_path = temp_path[0]
 
             base_path = os.path.basename(install_path)
@@ -86,31 +132,49 @@ class Camera:
             if build_mod.returncode != 0 or ins_mod.returncode != 0:
                 self._state = CameraState.ERROR
                 logger.error("Error building/inserting kernel module")
-                return
+                return False
+            return True
 
-        if not mod_check.stdout:
-            load_kernel_module()
-            sleep(5)
-            rm_mod = subprocess.run("rmmod prucam", capture_output=True, shell=True, check=False)
-            if rm_mod.returncode != 0:
-                self._state = CameraState.ERROR
-                logger.error("Error removing kernel module")
+        def wait_for_capture_path() -> bool:
+            # poll for the device node instead of sleeping a fixed amount of time
+            for _ in range(50):
+                if self.CAPTURE_PATH.exists():
+                    return True
+                sleep(0.1)
+            return False
+
+        if not mod_loaded:
+            if not load_kernel_module():
                 return
-            load_kernel_module()
+            if not wait_for_capture_path():
+                # only reload the kernel module if the first load did not bring up the device
+                logger.info("Capture path not found, reloading kernel module")
+                rm_mod = subprocess.run(
+                    "rmmod prucam", capture_output=True, shell=True, check=False
+                )
+                if rm_mod.returncode != 0:
+                    self._state = CameraState.ERROR
+                    logger.error("Error removing kernel module")
+                    return
+                if not load_kernel_module():
+                    return
 
-        sleep(0.5)
-        if not self.CAPTURE_PATH.exists():
+        if not wait_for_capture_path():
             self._state = CameraState.NOT_FOUND
             logger.error("Could not find capture path")
             return
 
-        # no errors; attempt to read image
+        # no errors; size the frame buffers before captures are let through
+        y_size = self._read_context_setting("y_size")
+        x_size = self._read_context_setting("x_size")
+        self._image_size = (y_size, x_size)
+        self._alloc_buffers()
         self._state = CameraState.RUNNING
-        self._image_size = self.read_image_size()
-        logger.info("Camera is unlocked")
+        logger.info(f"Camera is unlocked after {monotonic() - start:.1f} s")
 
     def read_image_size(self):
         """Read dimensions of image from the camera"""
+        self.check_lockout()
         if self._state != CameraState.RUNNING:
             raise CameraError(f"Camera error; state is {self._state}")
         if self._mock:
@@ -120,22 +184,22 @@ class Camera:
         return (y_size, x_size)
 
     def read_context_setting(self, name: str) -> int:
-        """'Read a context setting."""
+        """Read a context setting."""
         if self._state != CameraState.RUNNING:
             raise CameraError(f"Camera error; state is {self._state}")
-        context_path = "/sys/devices/platform/prucam/context_settings"
-        with open(f"{context_path}/{name}", "r") as f:
-            value = int(f.read())
-            return value
-        # path check
+        return self._read_context_setting(name)
+
+    def _read_context_setting(self, name: str) -> int:
+        with open(self.CONTEXT_PATH / name, "r") as f:
+            return int(f.read())
 
-    def capture(self, color: bool = True) -> np.ndarray:
+    def capture(self, mode: CaptureMode = CaptureMode.COLOR) -> np.ndarray:
         """Capture an image
 
         Parameters
         ----------
-        color: bool
-            enable color
+        mode: CaptureMode
+            what to convert the raw capture to
 
         Raises
         ------
@@ -145,34 +209,85 @@ class Camera:
         Returns
         -------
         numpy.ndarray
-            image data in numpy array
+            image data in numpy array; this is a view of an internal buffer that is overwritten
+            by the next capture, so copy it if it must outlive that
         """
 
+        self.check_lockout()
         if self._state != CameraState.RUNNING:
             raise CameraError(f"Camera error; state is {self._state}")
 
         if self._mock:
-            return self._mock_data
-        # Read raw data
+            return self._mock_data(mode == CaptureMode.COLOR)
+        # Read raw data straight into the preallocated frame buffer
         capture_path = str(self.CAPTURE_PATH)
         fd = os.open(capture_path, os.O_RDWR)
-        fio = io.FileIO(fd, closefd=False)
-        imgbuf = bytearray(self._image_size[0] * self._image_size[1])
-        fio.readinto(imgbuf)
-        fio.close()
-        os.close(fd)
-
-        # Convert to image
-        img = np.frombuffer(imgbuf, dtype=np.uint8).reshape(
-            self._image_size[0], self._image_size[1]
-        )
+        try:
+            size = os.readv(fd, [self._raw.data])
+        finally:
+            os.close(fd)
+        if size != self._raw.nbytes:
+            # the buffer is reused, so a short read would mix in the previous frame
+            raise CameraError(f"Short read from camera; got {size} of {self._raw.nbytes} bytes")
+        img = self._raw
 
-        # Convert to color
-        if color is True:
-            img = cv2.cvtColor(img, cv2.COLOR_BayerBG2BGR)
+        # Convert to grayscale or color; demosaic into the preallocated buffers
+        if mode == CaptureMode.GRAY:
+            img = self.to_gray(img)
+        elif mode == CaptureMode.COLOR:
+            img = self.demosaic(img)
 
         return img
 
+    def demosaic(self, raw: np.ndarray, reuse: bool = True) -> np.ndarray:
+        """Convert a raw capture to color
+
+        Parameters
+        ----------
+        raw: numpy.ndarray
+            raw bayer image data from :py:meth:`capture` in raw mode
+        reuse: bool
+            demosaic into the internal color buffer; disable to get a new array that can be kept
+
+        Returns
+        -------
+        numpy.ndarray
+            color image data; when reused this is a view of an internal buffer that is
+            overwritten by the next color capture or demosaic
+        """
+
+        # bilinear demosaic, into the preallocated color buffer unless the caller keeps it
+        return cv2.cvtColor(raw, cv2.COLOR_BayerBG2BGR, dst=self._bgr if reuse else None)
+
+    def to_gray(self, raw: np.ndarray) -> np.ndarray:
+        """Convert a raw capture to grayscale
+
+        Parameters
+        ----------
+        raw: numpy.ndarray
+            raw bayer image data from :py:meth:`capture` in raw mode
+
+        Returns
+        -------
+        numpy.ndarray
+            grayscale image data; this is a view of an internal buffer that is overwritten by
+            the next gray capture or conversion, so copy it if it must outlive that
+        """
+
+        # demosaic straight to grayscale in one pass into the preallocated gray buffer
+        return cv2.cvtColor(raw, cv2.COLOR_BayerBG2GRAY, dst=self._gray)
+
+    @classmethod
+    def _mock_data(cls, color: bool) -> np.ndarray:
+        """Get the shared mock frame, shaped like a raw or color capture."""
+
+        if color not in cls._mock_frames:
+            shape = (cls.MAX_ROWS, cls.MAX_COLS, 3) if color else (cls.MAX_ROWS, cls.MAX_COLS)
+            frame = np.zeros(shape, dtype=np.uint8)
+            frame.setflags(write=False)
+            cls._mock_frames[color] = frame
+        return cls._mock_frames[color]
+
     @property
     def state(self) -> CameraState:
         return self._state
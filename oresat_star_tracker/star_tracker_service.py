@@ -2,7 +2,9 @@
 
 from enum import IntEnum
 from io import BytesIO
-from time import monotonic, time
+from operator import itemgetter
+from time import monotonic, monotonic_ns, time
+from typing import Optional
 
 import canopen
 import cv2
@@ -11,7 +13,7 @@ import numpy as np
 import tifffile as tiff
 from olaf import Service, logger, new_oresat_file  # , set_cpufreq_gov
 
-from .camera import Camera, CameraError, CameraState
+from .camera import Camera, CameraError, CameraState, CaptureMode
 
 
 class State(IntEnum):
@@ -27,16 +29,19 @@ class State(IntEnum):
 
 
 STATE_TRANSISTIONS = {
-    State.OFF: [State.BOOT],
-    State.BOOT: [State.STANDBY],
-    State.STANDBY: [State.LOW_POWER, State.STAR_TRACK, State.CAPTURE_ONLY],
-    State.LOW_POWER: [State.STANDBY, State.STAR_TRACK, State.CAPTURE_ONLY],
-    State.STAR_TRACK: [State.STANDBY, State.LOW_POWER, State.CAPTURE_ONLY, State.ERROR],
-    State.CAPTURE_ONLY: [State.STANDBY, State.LOW_POWER, State.STAR_TRACK, State.ERROR],
-    State.ERROR: [State.OFF],
+    State.OFF: {State.BOOT},
+    State.BOOT: {State.STANDBY},
+    State.STANDBY: {State.LOW_POWER, State.STAR_TRACK, State.CAPTURE_ONLY},
+    State.LOW_POWER: {State.STANDBY, State.STAR_TRACK, State.CAPTURE_ONLY},
+    State.STAR_TRACK: {State.STANDBY, State.LOW_POWER, State.CAPTURE_ONLY, State.ERROR},
+    State.CAPTURE_ONLY: {State.STANDBY, State.LOW_POWER, State.STAR_TRACK, State.ERROR},
+    State.ERROR: {State.OFF},
 }
 """Valid status transistions."""
 
+ATTITUDE_GETTER = itemgetter("attitude_ra", "attitude_de", "attitude_roll")
+"""Get the right ascension, declination, and roll from LOST identify results."""
+
 
 class StarTrackerService(Service):
     """Star Tracker service."""
@@ -53,7 +58,8 @@ class StarTrackerService(Service):
             logger.debug("not mocking camera")
 
         self._camera = Camera(self.mock_hw)
-        self._last_capture = None
+        self._last_capture: Optional[np.ndarray] = None
+        self._lost_args = lost.identify_args(algo="tetra")
 
         self.status_obj: canopen.objectdictionary.Variable = None
         self._right_ascension_obj: canopen.objectdictionary.Variable = None
@@ -126,7 +132,7 @@ class StarTrackerService(Service):
         return encoded
 
     def _encode_compress_tiff(self, data: np.ndarray, meta=None) -> np.ndarray:
-        """Encode as an compress tiff."""
+        """Encode as a zlib (deflate) compressed tiff."""
 
         buff = BytesIO()
         tiff.imwrite(
@@ -134,49 +140,48 @@ class StarTrackerService(Service):
             data,
             dtype=data.dtype,
             metadata=meta,
+            compression="zlib",
         )
 
-        # Get the encoded TIFF data from the memory file
-        encoded_data = buff.getvalue()
-
-        # Convert the encoded TIFF data to a NumPy array
-        return np.frombuffer(encoded_data, dtype=np.uint8)
+        # View the encoded TIFF data in the memory file as a NumPy array, without copying it
+        return np.frombuffer(buff.getbuffer(), dtype=np.uint8)
 
     def _save_to_cache(self, file_keyword: str, encoded_data: np.ndarray, ext: str = ".tiff"):
         # save capture
         name = "/tmp/" + new_oresat_file(file_keyword, ext=ext)
         with open(name, "wb") as f:
-            f.write(encoded_data.tobytes())
+            f.write(encoded_data.data)
         logger.info(f"saved new capture {name}")
 
         # add capture to fread cache
         self.node.fread_cache.add(name, consume=True)
 
     def _filter(self, img: np.ndarray) -> bool:
+        lower_bound = self._lower_bound_obj.value
+        upper_bound = self._upper_bound_obj.value
+
         # If both bounds are ignored, return
-        if self._lower_bound_obj.value == 0 and self._upper_bound_obj.value == 0:
+        if lower_bound == 0 and upper_bound == 0:
             return True
 
-        # Convert the BGR image to grayscale
-        gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        # Demosaic the raw bayer image straight to grayscale
+        gray_img = self._camera.to_gray(img)
 
         # Check that enough pixels are bright enough
-        if self._lower_bound_obj.value != 0:
-            # Threshold the grayscale image for brightness check
-            bright_binary_image = np.where(gray_img > self._lower_bound_obj.value, 1, 0)
-            # Calculate the mean of lit pixels in the original grayscale image
-            lit_mean = np.mean(bright_binary_image) * 100
+        if lower_bound != 0:
+            # Calculate the percentage of lit pixels in the grayscale image
+            lit_pixels = np.count_nonzero(gray_img > lower_bound)
+            lit_mean = lit_pixels * 100 / gray_img.size
 
             # Check if the mean exceeds the threshold
             if lit_mean < self._lower_percentage_obj.value:
                 return False
 
         # Check that enough pixels are dim enough
-        if self._upper_bound_obj.value != 0:
-            # Threshold the grayscale image for dimness check
-            dim_binary_image = np.where(gray_img < self._upper_bound_obj.value, 1, 0)
-            # Calculate the mean of dim pixels in the original grayscale image
-            dim_mean = np.mean(dim_binary_image) * 100
+        if upper_bound != 0:
+            # Calculate the percentage of dim pixels in the grayscale image
+            dim_pixels = np.count_nonzero(gray_img < upper_bound)
+            dim_mean = dim_pixels * 100 / gray_img.size
 
             if dim_mean < self._upper_percentage_obj.value:
                 return False
@@ -189,7 +194,8 @@ class StarTrackerService(Service):
         # Take the image
         ts = time()
         try:
-            data = self._camera.capture()
+            # LOST only needs intensity, so demosaic straight to grayscale instead of BGR
+            data = self._camera.capture(CaptureMode.GRAY)
         except Exception:
             self._state = State.ERROR
             logger.error("Camera capture failure")
@@ -197,16 +203,16 @@ class StarTrackerService(Service):
             return
 
         # NOTE: Lost currently writes the capture to disk temporarily
-        lost_args = lost.identify_args(algo="tetra")
-        lost_data = lost.identify(data, lost_args)
+        lost_data = lost.identify(data, self._lost_args)
 
-        self._right_ascension_obj.value = int(lost_data["attitude_ra"])
-        self._declination_obj.value = int(lost_data["attitude_de"])
-        self._orientation_obj.value = int(lost_data["attitude_roll"])
+        right_ascension, declination, roll = ATTITUDE_GETTER(lost_data)
+        self._right_ascension_obj.value = int(right_ascension)
+        self._declination_obj.value = int(declination)
+        self._orientation_obj.value = int(roll)
 
         self._time_stamp_obj.value = int(ts)
         self._last_capture_time.value = int(ts)
-        self._last_capture = data
+        self._last_capture = data.copy()  # the camera reuses its frame buffers
 
         # Send the star tracker data TPDOs
         self.node.send_tpdo(3)
@@ -223,15 +229,20 @@ class StarTrackerService(Service):
         """Use camera for some amount of time."""
 
         img_count = 0
-        start_timestamp = time()
+
+        # settings are fixed for the whole capture run, so only read them once
+        deadline_ns = monotonic_ns() + int(self._capture_duration_obj.value * 1_000_000_000)
+        max_img_count = self._image_count_obj.value
+        filter_enable = self._filter_enable_obj.value
+        save = self._save_obj.value
+        delay = self._capture_delay_obj.value
 
         # Take images until either time runs out or image count has been reached
-        while time() - start_timestamp < self._capture_duration_obj.value and (
-            self._image_count_obj.value == 0 or img_count < self._image_count_obj.value
-        ):
+        while monotonic_ns() < deadline_ns and (max_img_count == 0 or img_count < max_img_count):
             ts = time()
             try:
-                data = self._camera.capture()
+                # capture raw; the filter only needs luma and rejected captures skip demosaicing
+                data = self._camera.capture(CaptureMode.RAW)
             except Exception:
                 self._state = State.ERROR
                 logger.error("Camera capture failure")
@@ -239,19 +250,22 @@ class StarTrackerService(Service):
                 return
 
             # Check if image passes filter
-            if not self._filter_enable_obj.value or not self._filter(data):
+            if filter_enable and not self._filter(data):
                 logger.debug("capture did not pass filter")
                 continue
 
+            # only captures that are kept get demosaiced, into a new array so it can be kept as is
+            data = self._camera.demosaic(data, reuse=False)
+
             self._last_capture_time.value = int(ts)
             self._last_capture = data
             img_count += 1
             logger.info(f"capture {img_count}")
 
-            if self._save_obj.value:
+            if save:
                 self._save_to_cache("img", self._encode_compress_tiff(data))  # Save image
 
-            self.sleep_ms(self._capture_delay_obj.value)
+            self.sleep_ms(delay)
 
         if img_count == 0:
             logger.info("no images taken, check camera mode settings and filter")
@@ -260,6 +274,8 @@ class StarTrackerService(Service):
         self._state = State.STANDBY
 
     def on_loop(self):
+        self._camera.check_lockout()
+
         if self._state == State.BOOT and monotonic() > 70:
             self._state = State.STANDBY
         elif self._state == State.STAR_TRACK:
@@ -329,11 +345,9 @@ class StarTrackerService(Service):
         if self._last_capture is None:
             return b""
 
-        data = np.copy(self._last_capture)
-
-        # downscale image
+        # downscale image; the last capture is never modified in place, so a view is enough
         downscale_factor = 2
-        data = data[::downscale_factor, ::downscale_factor]
+        data = self._last_capture[::downscale_factor, ::downscale_factor]
 
         ok, encoded = cv2.imencode(".jpg", data)
         if not ok:
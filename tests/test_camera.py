@@ -0,0 +1,41 @@
+"""
+test Camera lockout with a mock camera
+"""
+
+import unittest
+from unittest.mock import patch
+
+from oresat_star_tracker.camera import Camera, CameraState
+
+
+class TestCameraLockout(unittest.TestCase):
+    """Test the camera lockout is lifted by check_lockout"""
+
+    def test_stays_locked_before_unlock_time(self):
+        camera = Camera(mock=True)
+
+        with patch("oresat_star_tracker.camera.monotonic", return_value=Camera.UNLOCK_TIME - 1):
+            camera.check_lockout()
+
+        self.assertEqual(camera.state, CameraState.LOCKOUT)
+
+    def test_unlocks_after_unlock_time(self):
+        camera = Camera(mock=True)
+        self.assertEqual(camera.state, CameraState.LOCKOUT)
+
+        with patch("oresat_star_tracker.camera.monotonic", return_value=Camera.UNLOCK_TIME):
+            camera.check_lockout()
+
+        self.assertEqual(camera.state, CameraState.RUNNING)
+
+    def test_unlocks_in_background(self):
+        camera = Camera()
+
+        with patch.object(camera, "unlock") as unlock, patch(
+            "oresat_star_tracker.camera.monotonic", return_value=Camera.UNLOCK_TIME
+        ):
+            camera.check_lockout()
+            camera.check_lockout()
+            camera._unlock_thread.join()
+
+        unlock.assert_called_once()
@@ -0,0 +1,78 @@
+"""
+test StarTrackerService capture filter and capture only mode with a mock camera
+"""
+
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import numpy as np
+
+from oresat_star_tracker.star_tracker_service import StarTrackerService, State
+
+
+class TestCaptureOnly(unittest.TestCase):
+    """Test capture only mode keeps captures"""
+
+    def setUp(self):
+        self.service = StarTrackerService(mock_hw=True)
+        self.service._camera.unlock()
+
+        # stub OD variables, only their value is used
+        self.service._capture_delay_obj = SimpleNamespace(value=0)
+        self.service._capture_duration_obj = SimpleNamespace(value=10)
+        self.service._image_count_obj = SimpleNamespace(value=2)
+        self.service._last_capture_time = SimpleNamespace(value=0)
+        self.service._save_obj = SimpleNamespace(value=0)
+        self.service._filter_enable_obj = SimpleNamespace(value=0)
+        self.service._state = State.CAPTURE_ONLY
+
+    def test_captures_kept_with_filter_disabled(self):
+        with patch.object(self.service, "sleep_ms") as sleep_ms:
+            self.service._capture_only_mode()
+
+        self.assertEqual(sleep_ms.call_count, 2)
+        self.assertIsNotNone(self.service._last_capture)
+        self.assertEqual(self.service._last_capture.ndim, 3)
+        self.assertNotEqual(self.service._last_capture_time.value, 0)
+        self.assertEqual(self.service._state, State.STANDBY)
+
+
+class TestFilter(unittest.TestCase):
+    """Test the capture filter thresholds on a synthetic raw bayer frame"""
+
+    def setUp(self):
+        self.service = StarTrackerService(mock_hw=True)
+
+        # a quarter of the frame is lit, the rest is dark
+        self.frame = np.zeros((960, 1280), dtype=np.uint8)
+        self.frame[:240] = 200
+
+        # stub OD variables, only their value is used
+        self.service._lower_bound_obj = SimpleNamespace(value=0)
+        self.service._lower_percentage_obj = SimpleNamespace(value=0)
+        self.service._upper_bound_obj = SimpleNamespace(value=0)
+        self.service._upper_percentage_obj = SimpleNamespace(value=0)
+
+    def test_bounds_ignored(self):
+        self.service._lower_percentage_obj.value = 100
+        self.service._upper_percentage_obj.value = 100
+        self.assertTrue(self.service._filter(self.frame))
+
+    def test_lower_bound(self):
+        self.service._lower_bound_obj.value = 100
+
+        self.service._lower_percentage_obj.value = 20
+        self.assertTrue(self.service._filter(self.frame))
+
+        self.service._lower_percentage_obj.value = 30
+        self.assertFalse(self.service._filter(self.frame))
+
+    def test_upper_bound(self):
+        self.service._upper_bound_obj.value = 100
+
+        self.service._upper_percentage_obj.value = 70
+        self.assertTrue(self.service._filter(self.frame))
+
+        self.service._upper_percentage_obj.value = 80
+        self.assertFalse(self.service._filter(self.frame))